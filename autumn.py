@@ -8,6 +8,23 @@ A simple MySQL ORM, provides basic ORM functionalities in a Pythonic way.
 
 from __future__ import print_function
 
+import array
+import atexit
+import collections
+import csv
+import datetime
+import decimal
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import warnings
+
+from MySQLdb.cursors import SSCursor
+
 
 __version__ = "0.1.0"
 __author__ = "ushuz"
@@ -75,14 +92,75 @@ class Query(object):
     query `SELECT COUNT(0)`. Otherwise, it will return the length of results
     using `len()`.
 
+    Approximate counts are estimated from `information_schema` for queries
+    without conditions, and from `EXPLAIN` row estimates otherwise, which is
+    much cheaper on large InnoDB tables. MySQL 8 caches table statistics of
+    `information_schema` for `information_schema_stats_expiry` seconds, one
+    day by default, so the estimates may be even older than that
+
+        >>> Query(model=User).count(approximate=True)
+        1000213
+
+    Set `Query.count_cache_ttl` to cache counts for that many seconds. Cached
+    counts of a table are dropped on writes through autumn, but writes made
+    elsewhere are only seen once they expire
+
+        >>> Query.count_cache_ttl = 5
+
+    Export results column by column, rows are read from the cursor in batches
+    without creating any model instance
+
+        >>> columns = Query(model=User).where(name="John").to_columns()
+        >>> columns["age"]
+        array('l', [25, 30])
+        >>> Query(model=User).where(name="John").to_csv(open("john.csv", "wb"))
+        2
+        >>> Query(model=User).where(name="John").to_ndjson(sys.stdout)
+        {"age": 25, "id": 1, "name": "John"}
+        {"age": 30, "id": 2, "name": "John"}
+        2
+
+    Fields whose default value is an `int`, `long` or `float` are exported as
+    typed `array.array` columns, others as lists. A typed column falls back to
+    a list once it meets a value of another type, e.g. `NULL` or `Decimal`.
+    Results are read by a server-side cursor, so the connection can't be used
+    for other queries until the export is done.
+
+    Inspect the execution plan of a query
+
+        >>> Query(model=User).where(name="John").explain()
+        [{'id': 1, 'select_type': 'SIMPLE', 'table': 'user', 'type': 'ALL', ...}]
+
+    Set `Query.explain_mode` to "warn" or "raise" in development or staging,
+    so that the first execution of each statement shape is explained, and a
+    `QueryPlanWarning` is warned or raised if the plan contains a full table
+    scan, a filesort or a temporary table. `count()` and `delete()` are
+    checked as well. In "raise" mode, every execution of a bad shape raises,
+    while in "warn" mode it's warned only once
+
+        >>> Query.explain_mode = "warn"
+
+    Several queries can be fetched in one round trip, see `Pipeline`.
+
     Execute raw SQL
 
         >>> db = MySQLdb.connect(db="user")
         >>> query = "SELECT * FROM `user` WHERE id = %s"
         >>> values = (1,)
         >>> Query.execute(db=db, query=query, values=values)
+
+    Pass `cursorclass` to use another cursor, and `commit=False` to commit
+    by yourself, e.g. after reading all results of a server-side cursor.
     """
 
+    # None, "warn" or "raise", see `_check_plan()`
+    explain_mode = None
+    # {statement shape: (problems, plan)}
+    _explained = {}
+
+    # Seconds to cache counts for, 0 to disable
+    count_cache_ttl = 0
+
     def __init__(self, model, operation="SELECT *"):
         self._op = operation
 
@@ -137,11 +215,12 @@ class Query(object):
         return repr(self._results)
 
     @classmethod
-    def execute(cls, db, query, values=()):
-        cursor = db.cursor()
+    def execute(cls, db, query, values=(), cursorclass=None, commit=True):
+        cursor = db.cursor(cursorclass) if cursorclass else db.cursor()
         try:
             cursor.execute(query, values)
-            db.commit()
+            if commit:
+                db.commit()
         except Exception as e:
             print("SQL:", query, values)
             print(e)
@@ -171,10 +250,63 @@ class Query(object):
             self._cache = list(self._generator())
         return self._cache
 
+    def _cursor(self):
+        if Query.explain_mode:
+            self._check_plan()
+        return Query.execute(db=self._db, query=self._query,
+                             values=self._condition_params)
+
+    def _check_plan(self, query=None):
+        """Explain the statement once per shape and report bad plans.
+
+        `query` defaults to the `SELECT` statement of the query, its shape
+        ignores `LIMIT`.
+        """
+        if query is None:
+            query = self._query
+            shape = (self._db, self._op, self._model.table_name,
+                     self._where_condition, self._order_by)
+        else:
+            shape = (self._db, query)
+
+        reported = shape in Query._explained
+        if not reported:
+            plan = self._explain(query)
+            problems = []
+            for step in plan:
+                extra = step.get("Extra") or ""
+                if step.get("type") == "ALL":
+                    problems.append("full table scan on `{}`".format(
+                        step.get("table")))
+                if "Using filesort" in extra:
+                    problems.append("filesort")
+                if "Using temporary" in extra:
+                    problems.append("temporary table")
+            Query._explained[shape] = (problems, plan)
+
+        problems, plan = Query._explained[shape]
+        if not problems:
+            return
+        # Bad plans are raised on every execution, but warned only once
+        if reported and Query.explain_mode != "raise":
+            return
+
+        call_site = _call_site()
+        w = QueryPlanWarning(
+            "{} ({}) in {}:{}: {}".format(
+                ", ".join(problems), self._model.__name__, call_site[0],
+                call_site[1], query),
+            model=self._model, call_site=call_site, plan=plan)
+        if Query.explain_mode == "raise":
+            raise w
+        warnings.warn_explicit(w, QueryPlanWarning, call_site[0] or __file__,
+                               call_site[1] or 0)
+
     def _generator(self):
-        cursor = Query.execute(db=self._db, query=self._query,
-                               values=self._condition_params)
-        for row in cursor:
+        return self._hydrate(self._cursor())
+
+    def _hydrate(self, rows):
+        for row in rows:
             if row is None:
                 break
             o = self._model(*row)
@@ -199,27 +331,234 @@ class Query(object):
         self._order_by = "ORDER BY {}".format(order_by)
         return self
 
-    def count(self, what="0"):
+    def count(self, what="0", approximate=False):
         if (what == "0" or what == "*") and self._cache is not None:
             return len(self._cache)
 
-        cursor = Query.execute(
-            db=self._db,
-            query="SELECT COUNT({}) FROM `{}` {}".format(
-                what, self._model.table_name, self._where_condition),
-            values=self._condition_params)
-
-        return cursor.fetchone()[0]
+        table_name = self._model.table_name
+        key = (self._db, what, self._where_condition,
+               tuple(self._condition_params), approximate)
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable params, e.g. lists, can't be cached
+            key = None
+
+        if Query.count_cache_ttl and key is not None:
+            expires, count = _count_cache.get(table_name, {}).get(
+                key, (0, None))
+            if expires > time.time():
+                return count
+
+        count = None
+        if approximate and (what == "0" or what == "*"):
+            count = self._approximate_count()
+
+        if count is None:
+            query = "SELECT COUNT({}) FROM `{}` {}".format(
+                what, table_name, self._where_condition)
+            if Query.explain_mode:
+                self._check_plan(query)
+            cursor = Query.execute(db=self._db, query=query,
+                                   values=self._condition_params)
+            count = cursor.fetchone()[0]
+
+        if Query.count_cache_ttl and key is not None:
+            now = time.time()
+            entries = _count_cache.setdefault(table_name, {})
+            # Evict expired counts, or counts of tables rarely written would
+            # pile up, e.g. one for each page of each user
+            for k, (expires, _) in entries.items():
+                if expires <= now:
+                    entries.pop(k, None)
+            entries[key] = (now + Query.count_cache_ttl, count)
+
+        return count
+
+    def _approximate_count(self):
+        """Return estimated number of matching rows, or None if MySQL has no
+        idea."""
+        if not self._condition_literals:
+            cursor = Query.execute(
+                db=self._db,
+                query="SELECT `TABLE_ROWS` FROM `information_schema`.`TABLES` "
+                      "WHERE `TABLE_SCHEMA` = DATABASE() "
+                      "AND `TABLE_NAME` = %s",
+                values=(self._model.table_name,))
+            row = cursor.fetchone()
+            if row and row[0] is not None:
+                return int(row[0])
+
+        plan = self._explain("SELECT * FROM `{}` {}".format(
+            self._model.table_name, self._where_condition))
+        if not plan or plan[0].get("rows") is None:
+            return
+        # `filtered` is the estimated percentage of rows left by conditions,
+        # available since MySQL 5.7
+        filtered = plan[0].get("filtered")
+        if filtered is None:
+            filtered = 100
+        return int(plan[0]["rows"] * float(filtered) / 100)
 
     def delete(self):
-        cursor = Query.execute(
-            db=self._db,
-            query="DELETE FROM `{}` {}".format(
-                self._model.table_name, self._where_condition),
-            values=self._condition_params)
+        query = "DELETE FROM `{}` {}".format(
+            self._model.table_name, self._where_condition)
+        if Query.explain_mode:
+            self._check_plan(query)
+        cursor = Query.execute(db=self._db, query=query,
+                               values=self._condition_params)
+        _invalidate_count_cache(self._model.table_name)
 
         return cursor.rowcount
 
+    def explain(self):
+        """Return the plan of the query as a list of dicts, one per row of
+        `EXPLAIN` output."""
+        return self._explain(self._query)
+
+    def _explain(self, query):
+        cursor = Query.execute(db=self._db, query="EXPLAIN " + query,
+                               values=self._condition_params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def _stream(self):
+        """Execute the query by a server-side cursor, so that results can be
+        read in batches by `_batches()` without buffering them all."""
+        if Query.explain_mode:
+            self._check_plan()
+
+        # Results of a server-side cursor must be read before commit, see
+        # `_batches()`
+        return Query.execute(db=self._db, query=self._query,
+                             values=self._condition_params,
+                             cursorclass=SSCursor, commit=False)
+
+    def _batches(self, cursor, size):
+        """Yield rows read from a `_stream()` cursor, `size` rows at a time,
+        and commit once all rows are read."""
+        try:
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # Closing a server-side cursor discards unread rows
+            cursor.close()
+        self._db.commit()
+
+    def to_columns(self, batch_size=1000):
+        """Return a dict mapping each selected field to a column of values."""
+        cursor = self._stream()
+        names = [d[0] for d in cursor.description]
+        field_types = getattr(self._model, "_field_types", {})
+        columns = [_new_column(field_types.get(n)) for n in names]
+        accepted = [_column_types.get(field_types.get(n), (None, ()))[1]
+                    for n in names]
+
+        for rows in self._batches(cursor, batch_size):
+            for i, values in enumerate(zip(*rows)):
+                column = columns[i]
+                if isinstance(column, array.array):
+                    # Build the batch into an array first, so that a column
+                    # is switched to a list without being partially extended
+                    try:
+                        if not all(type(v) in accepted[i] for v in values):
+                            raise TypeError
+                        values = array.array(column.typecode, values)
+                    except (TypeError, OverflowError):
+                        column = columns[i] = column.tolist()
+                column.extend(values)
+
+        return dict(zip(names, columns))
+
+    def to_csv(self, fp, batch_size=1000, header=True):
+        """Write results to `fp` as CSV, return the number of rows written."""
+        cursor = self._stream()
+        writer = csv.writer(fp)
+        if header:
+            writer.writerow([d[0] for d in cursor.description])
+
+        count = 0
+        for rows in self._batches(cursor, batch_size):
+            writer.writerows(
+                [_csv_value(v) for v in row] for row in rows)
+            count += len(rows)
+
+        return count
+
+    def to_ndjson(self, fp, batch_size=1000):
+        """Write results to `fp` as newline delimited JSON objects, return the
+        number of rows written."""
+        cursor = self._stream()
+        names = [d[0] for d in cursor.description]
+
+        count = 0
+        for rows in self._batches(cursor, batch_size):
+            for row in rows:
+                fp.write(json.dumps(dict(zip(names, row)), sort_keys=True,
+                                    default=_json_default))
+                fp.write("\n")
+            count += len(rows)
+
+        return count
+
+
+# {table_name: {key: (expires, count)}}, see `Query.count()`
+_count_cache = {}
+
+
+def _invalidate_count_cache(table_name):
+    _count_cache.pop(table_name, None)
+
+
+class QueryPlanWarning(UserWarning):
+    """Warned or raised when `Query.explain_mode` is set and a query plan
+    contains a full table scan, a filesort or a temporary table."""
+
+    def __init__(self, message, model=None, call_site=None, plan=None):
+        super(QueryPlanWarning, self).__init__(message)
+        self.model = model
+        self.call_site = call_site
+        self.plan = plan
+
+
+def _call_site():
+    """Return `(filename, lineno, function)` of the innermost frame outside
+    this module."""
+    this = os.path.splitext(os.path.abspath(__file__))[0]
+    for filename, lineno, function, _ in reversed(traceback.extract_stack()):
+        if os.path.splitext(os.path.abspath(filename))[0] != this:
+            return filename, lineno, function
+    return None, None, None
+
+
+# {field type: (array typecode, types of values the array accepts)}
+_column_types = {
+    int: ("l", (int, long)),
+    long: ("l", (int, long)),
+    float: ("d", (float,)),
+}
+
+
+def _new_column(field_type):
+    """Return an empty column for values of `field_type`."""
+    typecode = _column_types.get(field_type, (None,))[0]
+    return array.array(typecode) if typecode else []
+
+
+def _csv_value(value):
+    return value.encode("utf-8") if isinstance(value, unicode) else value
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, datetime.timedelta)):
+        return str(value)
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
 
 def _default_table_name(name):
     """Translate `MyModel` to `my_model`."""
@@ -320,10 +659,30 @@ class Model(object):
     We can add `ORDER BY` to SQL queries by `order_by`.
 
         >>> m = MyModel.where(field=1).order_by("id DESC")
+
+    Bulk load records, from tuples in column order, dicts or model instances
+
+        >>> MyModel.load([(1, "a"), (2, "b")])
+        LoadResult(rows=2, warnings=0)
+        >>> MyModel.load(({"field": i} for i in xrange(10 ** 6)),
+        ...              fields=("field",), duplicates="ignore")
+        LoadResult(rows=1000000, warnings=0)
+
+    Rows are written into a temporary file `batch_size` rows at a time, and
+    loaded by `LOAD DATA LOCAL INFILE`. If local infile is disabled by the
+    client or server, multi-row `INSERT` is used instead. `local_infile=1` is
+    required to connect with MySQLdb for local infile.
+
+    Updates can be buffered and written in batches by a `WriteBehind`, see
+    its docstring for details.
+
+        >>> MyModel.write_behind = WriteBehind(max_size=500, interval=1)
     """
 
     __metaclass__ = ModelMetaclass
 
+    write_behind = None
+
     def __init__(self, *args, **kwargs):
         self._pk_value = None
         self._is_new_record = True
@@ -379,6 +738,107 @@ class Model(object):
     def where(cls, *args, **kwargs):
         return Query(model=cls).where(*args, **kwargs)
 
+    @classmethod
+    def load(cls, iterable, fields=None, duplicates=None, batch_size=10000):
+        """Load rows into the table, return a `LoadResult`.
+
+        `duplicates` may be "replace" or "ignore" to replace or skip rows
+        having duplicate keys. Otherwise, MySQL's defaults apply, `LOAD DATA
+        LOCAL` skips them with warnings while `INSERT` raises an error.
+
+        `rows` of the result counts rows inserted or replaced, rows skipped
+        are not counted.
+        """
+        if duplicates not in (None, "replace", "ignore"):
+            raise ValueError("duplicates must be None, 'replace' or 'ignore'")
+
+        fields = tuple(fields or cls._fields)
+        result = LoadResult(0, 0)
+        local_infile = True
+
+        batch = []
+        for row in iterable:
+            if isinstance(row, Model):
+                # Same as `save()`, fields not set take their default values
+                row._set_default_values()
+                row = [getattr(row, f, None) for f in fields]
+            elif isinstance(row, dict):
+                row = [row.get(f) for f in fields]
+            batch.append(row)
+
+            if len(batch) >= batch_size:
+                r, local_infile = cls._load_batch(
+                    batch, fields, duplicates, local_infile)
+                result = LoadResult(*map(sum, zip(result, r)))
+                batch = []
+
+        if batch:
+            r, local_infile = cls._load_batch(
+                batch, fields, duplicates, local_infile)
+            result = LoadResult(*map(sum, zip(result, r)))
+
+        return result
+
+    @classmethod
+    def _load_batch(cls, rows, fields, duplicates, local_infile):
+        """Load rows by `LOAD DATA LOCAL INFILE`, or by `INSERT` if local
+        infile is not allowed. Return a `LoadResult` and whether local infile
+        should be tried for following batches."""
+        columns = ", ".join("`{}`".format(f) for f in fields)
+
+        if local_infile:
+            with tempfile.NamedTemporaryFile(suffix=".tsv") as fp:
+                for row in rows:
+                    fp.write("\t".join(_infile_value(v) for v in row))
+                    fp.write("\n")
+                fp.flush()
+
+                query = "LOAD DATA LOCAL INFILE %s {} INTO TABLE `{}` " \
+                    "CHARACTER SET utf8mb4 ({})".format(
+                        (duplicates or "").upper(), cls.table_name, columns)
+                try:
+                    return cls._execute_load(query, (fp.name,)), True
+                except Exception as e:
+                    if not e.args or e.args[0] not in _LOCAL_INFILE_ERRORS:
+                        raise
+
+        query = "{} INTO `{}` ({}) VALUES ({})".format(
+            {None: "INSERT", "ignore": "INSERT IGNORE",
+             "replace": "REPLACE"}[duplicates],
+            cls.table_name, columns, ", ".join(("%s",) * len(fields)))
+        return cls._execute_load(
+            query, rows, many=True, replace=duplicates == "replace"), False
+
+    @classmethod
+    def _execute_load(cls, query, values, many=False, replace=False):
+        # Warnings must be counted before commit, so `Query.execute` isn't
+        # used here
+        db = cls.database
+        cursor = db.cursor()
+        try:
+            if many:
+                cursor.executemany(query, values)
+                # Affected rows of `REPLACE` count a replaced row twice, as
+                # deleted and inserted, while every row is written
+                rows = len(values) if replace else cursor.rowcount
+            else:
+                cursor.execute(query, values)
+                # `LOAD DATA` reports like "Records: 3  Deleted: 1  Skipped: 0
+                # Warnings: 0", where affected rows have the same problem
+                info = dict(re.findall(r"(\w+): (\d+)", db.info() or ""))
+                if "Records" in info:
+                    rows = int(info["Records"]) - int(info.get("Skipped", 0))
+                else:
+                    rows = cursor.rowcount
+            result = LoadResult(rows, db.warning_count())
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        _invalidate_count_cache(cls.table_name)
+
+        return result
+
     @property
     def _pk(self):
         return self._pk_value
@@ -421,6 +881,7 @@ class Model(object):
             ", ".join(("%s",) * len(used_fields)))
 
         cursor = Query.execute(db=self.database, query=query, values=values)
+        _invalidate_count_cache(self.table_name)
 
         if getattr(self, self.primary_key, None) is None:
             self._pk = cursor.lastrowid
@@ -441,6 +902,7 @@ class Model(object):
         values.append(self._pk)
 
         Query.execute(db=self.database, query=query, values=values)
+        _invalidate_count_cache(self.table_name)
 
         # Update primary key value after the execution of a query as it may be
         # changed too
@@ -455,7 +917,16 @@ class Model(object):
             self._is_new_record = False
 
         elif self._changed_fields:
-            self._update()
+            # Changing primary key can't be deferred, as later updates of the
+            # record would be buffered with the new one
+            if self.write_behind is not None and \
+                    self.primary_key not in self._changed_fields:
+                self.write_behind.add(self)
+            else:
+                # Write changes buffered under the old primary key first
+                if self.write_behind is not None:
+                    self.write_behind.flush(self)
+                self._update()
 
         self._changed_fields.clear()
 
@@ -465,11 +936,16 @@ class Model(object):
         """Delete the record."""
         self.before_delete()
 
+        # Buffered changes must not be written to a record re-inserted later
+        if self.write_behind is not None:
+            self.write_behind.discard(self)
+
         query = "DELETE FROM `{}` WHERE `{}` = %s".format(
             self.table_name, self.primary_key)
         values = (self._pk,)
 
         Query.execute(db=self.database, query=query, values=values)
+        _invalidate_count_cache(self.table_name)
 
         self.after_delete()
 
@@ -489,3 +965,291 @@ class Model(object):
 
     def after_delete(self):
         pass
+
+
+LoadResult = collections.namedtuple("LoadResult", ("rows", "warnings"))
+
+# Client and server errors telling local infile is not allowed
+_LOCAL_INFILE_ERRORS = (1148, 2068, 3948)
+
+
+def _infile_value(value):
+    """Format a value as a field of `LOAD DATA` default format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif isinstance(value, bool):
+        value = str(int(value))
+    elif isinstance(value, float):
+        # `str()` keeps only 12 significant digits
+        value = repr(value)
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r").replace("\0", "\\0")
+
+
+class WriteBehind(object):
+    """Buffer updates of models and write them in batches.
+
+    Assign a `WriteBehind` to `Model.write_behind` to enable it for all
+    models, or to `MyModel.write_behind` for a single model
+
+        >>> MyModel.write_behind = WriteBehind(max_size=500, interval=1)
+
+    Once enabled, `save()` of an existing record puts its changed fields into
+    the buffer instead of executing `UPDATE` right away. Changes of the same
+    record are merged, so a counter incremented ten times is written once.
+    New records, deletions and primary key changes are never buffered.
+
+    The buffer is flushed when it holds `max_size` records, every `interval`
+    seconds by a background thread, on `flush()`, and at interpreter exit.
+    Records having the same changed fields are updated by a single statement,
+    `UPDATE ... SET field = CASE pk WHEN ... END WHERE pk IN (...)`, and
+    committed together. `before_update()` runs when a record is buffered and
+    `after_update()` once it has been written.
+
+    MySQLdb connections are not thread-safe, so a dedicated `database`
+    connection is required if `interval` is set. A single connection serves
+    models of one database only. For models of several databases, pass a
+    dict mapping each `MyModel.database` to its dedicated connection
+
+        >>> Model.write_behind = WriteBehind(interval=1, database={
+        ...     User.database: MySQLdb.connect(db="user"),
+        ...     Order.database: MySQLdb.connect(db="order"),
+        ... })
+
+    Records added after `close()` are written right away. Buffered changes of
+    a record are written before its primary key is changed, and dropped when
+    it's deleted.
+
+    If a flush fails, `on_error(exception, instances)` is called with the
+    records that were not written. By default the error is printed.
+    """
+
+    def __init__(self, max_size=1000, interval=None, database=None,
+                 on_error=None):
+        if interval and database is None:
+            raise ValueError("a dedicated database connection is required "
+                             "for flushing in background")
+
+        self.max_size = max_size
+        self.interval = interval
+        self.database = database
+        self.on_error = on_error or self._print_error
+
+        # Database of models served by a single dedicated connection
+        self._source = None
+        # {(model, pk): (instance, {field: value})}
+        self._buffer = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        atexit.register(self.close)
+
+        if interval:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._thread = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, instance):
+        """Buffer changed fields of `instance`."""
+        if isinstance(self.database, dict):
+            if instance.database not in self.database:
+                raise ValueError("no dedicated connection for the database "
+                                 "of {}".format(instance.__class__.__name__))
+        elif self.database is not None:
+            with self._lock:
+                if self._source is None:
+                    self._source = instance.database
+            if instance.database is not self._source:
+                raise ValueError("a single connection can't serve models of "
+                                 "several databases, pass a dict instead")
+
+        instance.before_update()
+
+        changes = {f: getattr(instance, f) for f in instance._changed_fields}
+        key = (instance.__class__, instance._pk)
+        with self._lock:
+            if key in self._buffer:
+                changes = dict(self._buffer[key][1], **changes)
+            self._buffer[key] = (instance, changes)
+            full = len(self._buffer) >= self.max_size
+
+        if full or self._closed.is_set():
+            self.flush()
+
+    def discard(self, instance):
+        """Drop buffered changes of `instance` without writing them."""
+        with self._lock:
+            self._buffer.pop((instance.__class__, instance._pk), None)
+
+    def flush(self, instance=None):
+        """Write buffered changes, of `instance` only if given, return the
+        number of records written."""
+        with self._flush_lock:
+            with self._lock:
+                if instance is None:
+                    buffer, self._buffer = self._buffer, {}
+                else:
+                    key = (instance.__class__, instance._pk)
+                    buffer = {key: self._buffer.pop(key)} \
+                        if key in self._buffer else {}
+
+            # Group records by model and changed fields, so that each group
+            # can be updated by a single statement
+            groups = {}
+            for (model, pk), (instance, changes) in buffer.iteritems():
+                fields = tuple(sorted(changes))
+                groups.setdefault((model, fields), []).append(
+                    (instance, pk, changes))
+
+            count = 0
+            for (model, fields), records in groups.iteritems():
+                case = "CASE `{}` {} END".format(
+                    model.primary_key,
+                    " ".join(("WHEN %s THEN %s",) * len(records)))
+                query = "UPDATE `{}` SET {} WHERE `{}` IN ({})".format(
+                    model.table_name,
+                    ", ".join(("`{}` = {}".format(f, case) for f in fields)),
+                    model.primary_key,
+                    ", ".join(("%s",) * len(records)))
+
+                values = []
+                for f in fields:
+                    for _, pk, changes in records:
+                        values.extend((pk, changes[f]))
+                values.extend(pk for _, pk, _ in records)
+
+                try:
+                    Query.execute(db=self._connection(model),
+                                  query=query, values=values)
+                except Exception as e:
+                    self.on_error(e, [r[0] for r in records])
+                    continue
+                _invalidate_count_cache(model.table_name)
+
+                for instance, _, _ in records:
+                    instance.after_update()
+                count += len(records)
+
+            return count
+
+    def _connection(self, model):
+        if self.database is None:
+            return model.database
+        if isinstance(self.database, dict):
+            return self.database[model.database]
+        return self.database
+
+    def close(self):
+        """Stop the background thread and flush the buffer."""
+        self._closed.set()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.on_error(e, [])
+
+    @staticmethod
+    def _print_error(exception, instances):
+        print("WriteBehind: failed to write", len(instances), "records")
+        print(exception)
+
+
+class Pipeline(object):
+    """Fetch results of several queries in one round trip.
+
+    Queries added to a pipeline are sent as a single multi-statement batch
+    when the `with` block exits, and their results are cached in the queries
+
+        >>> with Pipeline() as p:
+        ...     johns = p.add(User.where(name="John"))
+        ...     bob = p.get(User, name="Bob")
+        ...
+        >>> len(johns)
+        2
+        >>> bob[0].name
+        'Bob'
+
+    `get()` works like `Model.get()` but returns a query of at most one
+    result, as nothing is fetched yet. Like `Model.get()`, it returns `None`
+    without any condition. Queries are batched per connection,
+    which must be opened with `CLIENT.MULTI_STATEMENTS`, the default of
+    mysqlclient.
+    """
+
+    def __init__(self):
+        self._queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, query):
+        """Add a query to the pipeline and return it."""
+        self._queries.append(query)
+        return query
+
+    def get(self, model, pk=None, **kwargs):
+        """Add a query for the first result of `model` and return it."""
+        if pk is None and not kwargs:
+            return
+
+        if pk is not None:
+            kwargs = {model.primary_key: pk}
+
+        q = Query(model=model).where(**kwargs)
+        q._limit = (0, 1)
+        return self.add(q)
+
+    def execute(self):
+        """Fetch results of all pending queries."""
+        queries, self._queries = self._queries, []
+
+        # Group queries by connection, preserving order
+        groups = collections.OrderedDict()
+        for q in queries:
+            if q._cache is None:
+                groups.setdefault(q._db, []).append(q)
+
+        for db, group in groups.iteritems():
+            if Query.explain_mode:
+                for q in group:
+                    q._check_plan()
+
+            query = ";\n".join(q._query for q in group)
+            values = [v for q in group for v in q._condition_params]
+
+            cursor = db.cursor()
+            try:
+                cursor.execute(query, values)
+                results = []
+                for _ in group:
+                    results.append(cursor.fetchall())
+                    cursor.nextset()
+                db.commit()
+            except Exception as e:
+                print("SQL:", query, values)
+                print(e)
+                db.rollback()
+                raise
+
+            for q, rows in zip(group, results):
+                q._cache = list(q._hydrate(rows))
@@ -2,9 +2,11 @@
 
 import MySQLdb
 
+from nose.plugins.skip import SkipTest
 from nose.tools import with_setup
 
-from autumn import Query, Model, _default_table_name
+from autumn import Query, Model, Pipeline, QueryPlanWarning, WriteBehind, \
+    _count_cache, _default_table_name, _infile_value
 
 
 data = [
@@ -123,6 +125,51 @@ def test_query_count():
     assert Query(model=UserMock).where(name="John").count("distinct(`name`)") == 1
 
 
+@with_setup(setup_database)
+def test_query_count_approximate():
+    cursor = database.cursor()
+    try:
+        # MySQL 8 caches table statistics of information_schema
+        cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+    except MySQLdb.OperationalError:
+        pass
+    cursor.execute("ANALYZE TABLE `user`")
+    cursor.fetchall()
+    assert abs(Query(model=UserMock).count(approximate=True) - 3) <= 1
+    assert Query(model=UserMock).where(id=1).count(approximate=True) == 1
+    # Falls back to exact count for expressions
+    assert Query(model=UserMock).count("distinct(`name`)", approximate=True) == 2
+
+
+@with_setup(setup_database)
+def test_query_count_cache():
+    Query.count_cache_ttl = 60
+    try:
+        assert Query(model=UserMock).where(name="John").count() == 2
+
+        # Writes made elsewhere are not seen until expired
+        cursor = database.cursor()
+        cursor.execute("INSERT INTO `user` (`name`) VALUES ('John')")
+        database.commit()
+        assert Query(model=UserMock).where(name="John").count() == 2
+
+        # Writes through autumn drop cached counts of the table
+        User(name="John").save()
+        assert Query(model=UserMock).where(name="John").count() == 4
+        assert Query(model=UserMock).where(name="John").delete() == 4
+        assert Query(model=UserMock).where(name="John").count() == 0
+
+        # Expired counts are evicted
+        Query(model=UserMock).where(name="Bob").count()
+        cache = _count_cache["user"]
+        for key, (expires, count) in cache.items():
+            cache[key] = (0, count)
+        Query(model=UserMock).where(name="Tom").count()
+        assert len(_count_cache["user"]) == 1
+    finally:
+        Query.count_cache_ttl = 0
+
+
 @with_setup(setup_database)
 def test_query_delete():
     assert Query(model=UserMock).where(name="Bob").count() == 1
@@ -130,6 +177,95 @@ def test_query_delete():
     assert Query(model=UserMock).where(name="Bob").count() == 0
 
 
+@with_setup(setup_database)
+def test_query_to_columns():
+    columns = Query(model=UserMock).where(name="John").to_columns(batch_size=1)
+    assert columns == {"id": [1, 2], "name": ["John", "John"], "age": [25, 30]}
+
+    class User(Model):
+        database = database
+        age = 0
+
+    columns = Query(model=User).to_columns()
+    assert columns["age"].typecode == "l"
+    assert list(columns["age"]) == [25, 30, 30]
+
+    # Typed columns fall back to lists on NULL
+    cursor = database.cursor()
+    cursor.execute("INSERT INTO `user` (`name`) VALUES ('Tom')")
+    database.commit()
+    assert Query(model=User).to_columns()["age"] == [25, 30, 30, None]
+    assert Query(model=User).to_columns(batch_size=2)["age"] == \
+        [25, 30, 30, None]
+
+    # Typed columns fall back to lists on values of other types
+    from decimal import Decimal
+    q = Query(model=User, operation="SELECT CAST(`age` / 2 AS DECIMAL(5, 1)) AS `age`")
+    columns = q.where("`age` IS NOT NULL").to_columns()
+    assert columns["age"] == [Decimal("12.5"), Decimal("15.0"), Decimal("15.0")]
+
+
+@with_setup(setup_database)
+def test_query_to_csv_ndjson():
+    from StringIO import StringIO
+
+    fp = StringIO()
+    assert Query(model=UserMock).where(name="John").to_csv(fp, batch_size=1) == 2
+    assert fp.getvalue() == "id,name,age\r\n1,John,25\r\n2,John,30\r\n"
+
+    fp = StringIO()
+    assert Query(model=UserMock).where(name="Bob").to_ndjson(fp) == 1
+    assert fp.getvalue() == '{"age": 30, "id": 3, "name": "Bob"}\n'
+
+
+@with_setup(setup_database)
+def test_query_explain():
+    plan = Query(model=UserMock).where(id=1).explain()
+    assert plan[0]["table"] == "user"
+    assert plan[0]["key"] == "PRIMARY"
+
+
+@with_setup(setup_database)
+def test_query_explain_mode():
+    import warnings
+
+    Query.explain_mode = "warn"
+    try:
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            list(Query(model=UserMock).where(id=1))
+            list(Query(model=UserMock).where(name="John"))
+            list(Query(model=UserMock).where(name="Bob"))
+        # Each statement shape is explained only once
+        assert len(w) == 1
+        assert issubclass(w[0].category, QueryPlanWarning)
+        assert w[0].message.model is UserMock
+        assert w[0].message.call_site[2] == "test_query_explain_mode"
+
+        # COUNT and DELETE statements are checked too
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            Query(model=UserMock).where(id=1).count()
+            Query(model=UserMock).where(name="John").count()
+            Query(model=UserMock).where(name="Nobody").delete()
+        assert len(w) == 2
+        assert "COUNT(0)" in str(w[0].message)
+        assert "DELETE" in str(w[1].message)
+
+        # Bad plans are raised on every execution
+        Query.explain_mode = "raise"
+        for _ in range(2):
+            try:
+                list(Query(model=UserMock).order_by("age"))
+            except QueryPlanWarning as e:
+                assert "filesort" in str(e)
+            else:
+                assert False
+    finally:
+        Query.explain_mode = None
+        Query._explained.clear()
+
+
 # TODO: Test various fields type, especially DATETIME, DECIMAL.
 
 
@@ -244,6 +380,242 @@ def test_model_default_values():
     assert list(Query(model=UserMock).where(id=4)) == [(4, "John Doe", None)]
 
 
+@with_setup(setup_database)
+def test_model_load():
+    result = User.load([(4, "Tom", 50), {"id": 5, "name": "May\tJune"},
+                        User(6, "Paul", 65)])
+    assert result.rows == 3
+    assert list(Query(model=UserMock).where("id > 3")) == \
+        [(4, "Tom", 50), (5, "May\tJune", None), (6, "Paul", 65)]
+
+    # Fields not set take their default values as save() does
+    class DefaultUser(Model):
+        database = database
+        table_name = "user"
+        age = 18
+
+    User.load([DefaultUser(id=9, name="Kid")])
+    assert User.get(9).age == 18
+
+    result = User.load([("Bob", 7), ("Jane", 8)], fields=("name", "id"),
+                       batch_size=1)
+    assert result.rows == 2
+    assert User.get(8).name == "Jane"
+
+    assert User.load([(1, "Johnson", 26)], duplicates="replace").rows == 1
+    assert (User.get(1).name, User.get(1).age) == ("Johnson", 26)
+
+    User.load([(2, "Johnson", 31)], duplicates="ignore")
+    assert (User.get(2).name, User.get(2).age) == ("John", 30)
+
+    try:
+        User.load([], duplicates="update")
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+@with_setup(setup_database)
+def test_model_load_local_infile():
+    db = MySQLdb.connect(db="test", local_infile=1)
+    cursor = db.cursor()
+    cursor.execute("SELECT @@GLOBAL.local_infile")
+    local_infile = cursor.fetchone()[0]
+    try:
+        cursor.execute("SET GLOBAL local_infile = 1")
+    except MySQLdb.OperationalError:
+        db.close()
+        raise SkipTest("privilege to enable local_infile required")
+
+    try:
+        _test_model_load_local_infile(db)
+    finally:
+        cursor.execute("SET GLOBAL local_infile = %s", (local_infile,))
+        db.close()
+
+
+def _test_model_load_local_infile(db):
+    class User(Model):
+        database = db
+
+    def loads():
+        cursor = db.cursor()
+        cursor.execute("SHOW SESSION STATUS LIKE 'Com_load'")
+        return int(cursor.fetchone()[1])
+
+    # See test_model_create() for storing emoji
+    result = User.load([(4, "Tom\tTommy", 50), (5, "a\\b\nc", None),
+                        (6, "😜", 27)])
+    assert loads() == 1
+    assert result == (3, 0)
+    assert list(Query(model=UserMock).where("id > 3")) == \
+        [(4, "Tom\tTommy", 50), (5, "a\\b\nc", None), (6, "😜", 27)]
+
+    result = User.load([(1, "Johnson", 26), (7, "Jane", 20)],
+                       duplicates="replace")
+    assert loads() == 2
+    assert result.rows == 2
+    assert (User.get(1).name, User.get(1).age) == ("Johnson", 26)
+
+    result = User.load([(2, "Johnson", 31), (8, "Jack", 21)],
+                       duplicates="ignore")
+    assert loads() == 3
+    assert result.rows == 1
+    assert (User.get(2).name, User.get(2).age) == ("John", 30)
+    assert User.get(8).name == "Jack"
+
+
+def test_infile_value():
+    assert _infile_value(None) == "\\N"
+    assert _infile_value(True) == "1"
+    assert _infile_value(1.5) == "1.5"
+    assert _infile_value(1234567.891234) == "1234567.891234"
+    assert _infile_value(u"\u00e9") == "\xc3\xa9"
+    assert _infile_value("a\\b\tc\nd\re\0") == "a\\\\b\\tc\\nd\\re\\0"
+
+
+@with_setup(setup_database)
+def test_model_write_behind():
+    User.write_behind = wb = WriteBehind(max_size=3)
+    try:
+        u = User.get(1)
+        for age in range(26, 36):
+            u.age = age
+            u.save()
+        u.name = "Johnson"; u.save()
+        User.get(2).update(age=31)
+
+        # Changes of the same record are merged
+        assert len(wb) == 2
+        assert User.get(1).age == 25
+
+        assert wb.flush() == 2
+        assert len(wb) == 0
+        assert (User.get(1).name, User.get(1).age) == ("Johnson", 35)
+        assert User.get(2).age == 31
+
+        # Flushed once the buffer is full
+        for pk in (1, 2, 3):
+            User.get(pk).update(age=40)
+        assert len(wb) == 0
+        assert User.where(age=40).count() == 3
+
+        # Primary key changes are not buffered
+        User.get(3).update(id=4)
+        assert len(wb) == 0
+        assert User.get(4).name == "Bob"
+
+        # Buffered changes are written before primary key changes
+        u = User.get(4); u.age = 41; u.save()
+        assert len(wb) == 1
+        u.id = 5; u.save()
+        assert len(wb) == 0
+        assert (User.get(5).name, User.get(5).age) == ("Bob", 41)
+
+        # Buffered changes are dropped on delete
+        u = User.get(5); u.age = 42; u.save()
+        u.delete()
+        assert len(wb) == 0
+        User.load([(5, "Bob", 30)], duplicates="replace")
+        assert wb.flush() == 0
+        assert User.get(5).age == 30
+
+        # Failed records are reported
+        errors = []
+        wb.on_error = lambda e, instances: errors.append(instances)
+        u = User.get(5); u.name = "Bobby"; u.save()
+        clear_database()
+        assert wb.flush() == 0
+        assert errors == [[u]]
+    finally:
+        User.write_behind = None
+        wb.close()
+
+    # Records added after close are written right away
+    setup_database()
+    User.write_behind = wb
+    try:
+        User.get(1).update(age=50)
+        assert len(wb) == 0
+        assert User.get(1).age == 50
+    finally:
+        User.write_behind = None
+
+    # Flushing in background requires a dedicated connection
+    try:
+        WriteBehind(interval=1)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+@with_setup(setup_database)
+def test_model_write_behind_connections():
+    other = MySQLdb.connect(db="test")
+    dedicated = MySQLdb.connect(db="test")
+
+    class OtherUser(Model):
+        database = other
+        table_name = "user"
+
+    # A single connection serves models of one database only
+    Model.write_behind = wb = WriteBehind(database=dedicated)
+    try:
+        User.get(1).update(age=26)
+        try:
+            OtherUser.get(2).update(age=31)
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        Model.write_behind = None
+        wb.close()
+    assert User.get(1).age == 26
+
+    # Otherwise, each database is mapped to its dedicated connection
+    Model.write_behind = wb = WriteBehind(
+        database={database: dedicated, other: dedicated})
+    try:
+        User.get(1).update(age=27)
+        OtherUser.get(2).update(age=32)
+        assert wb.flush() == 2
+    finally:
+        Model.write_behind = None
+        wb.close()
+    assert (User.get(1).age, User.get(2).age) == (27, 32)
+
+    other.close()
+    dedicated.close()
+
+
+@with_setup(setup_database)
+def test_pipeline():
+    with Pipeline() as p:
+        johns = p.add(User.where(name="John").order_by("id"))
+        bob = p.get(User, name="Bob")
+        nobody = p.get(User, 4)
+        mocks = p.add(Query(model=UserMock).where("age > %s", 29))
+        assert p.get(User) is None
+        assert len(p._queries) == 4
+        # Nothing is fetched until the block exits
+        assert johns._cache is None
+
+    assert [u.id for u in johns] == [1, 2]
+    assert not johns[0]._is_new_record
+    assert bob[0].name == "Bob"
+    assert list(nobody) == []
+    assert list(mocks) == data[1:]
+
+    # Queries already fetched are not sent again
+    with Pipeline() as p:
+        p.add(johns)
+        johns3 = p.add(User.where(name="John"))
+    assert len(johns3) == 2
+
+
 @with_setup(setup_database)
 def test_autumn_coverage():
     # Cover unimportant lines to simplify coverage report.